@@ -3,11 +3,13 @@ import glob
 import json
 import time
 import re
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError, wait, FIRST_COMPLETED
 from flask import Flask, render_template, request, jsonify, Response, stream_with_context
 import logging
 import google.generativeai as genai
-from docx import Document
-from pypdf import PdfReader
 from reportlab.lib.pagesizes import letter
 from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
 from reportlab.lib.styles import getSampleStyleSheet
@@ -15,10 +17,16 @@ from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
 from dotenv import load_dotenv
 import subprocess
+from cassette import get_transport
+from documents import extract_text_from_file
 
 load_dotenv()
 #test to push#
 app = Flask(__name__)
+# Reject oversized uploads before Werkzeug buffers them. The rubric is the only file in the
+# request; the extra 1 MB covers the other form fields and multipart framing.
+# documents.read_limited still enforces MAX_DOCUMENT_MB on the file itself.
+app.config['MAX_CONTENT_LENGTH'] = int((float(os.getenv('MAX_DOCUMENT_MB', 25)) + 1) * 1024 * 1024)
 
 # Configure logging
 logging.basicConfig(
@@ -27,21 +35,77 @@ logging.basicConfig(
     format='%(asctime)s - %(levelname)s - %(message)s'
 )
 
+# How often the /grade stream writes a blank line while waiting on Gemini.
+# Writing is the only way to notice that the browser has gone away.
+HEARTBEAT_INTERVAL = 2 # seconds
 
-def extract_text_from_file(file_storage):
+# Per-stage deadlines for Gemini calls
+PROCESSING_TIMEOUT = float(os.getenv('PROCESSING_TIMEOUT', 180)) # seconds to wait for an upload to become ACTIVE
+GENERATE_TIMEOUT = float(os.getenv('GENERATE_TIMEOUT', 300)) # seconds per generate_content call
+
+# Hedged requests: if a generate call is slower than the given percentile of recent calls,
+# a duplicate is sent and whichever finishes first wins. HEDGE_BUDGET caps the share of
+# calls that may be duplicated.
+HEDGE_ENABLED = os.getenv('HEDGE_ENABLED', 'false').lower() == 'true'
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', 0.9))
+HEDGE_BUDGET = float(os.getenv('HEDGE_BUDGET', 0.1))
+HEDGE_MIN_SAMPLES = 5 # calls observed before hedging starts
+
+# Latency stats are kept per call kind ('grade', 'regrade', 'summary'), since their durations differ
+hedge_lock = threading.Lock()
+hedge_stats = {}
+hedge_executor = ThreadPoolExecutor(max_workers=8)
+
+# All Gemini calls go through the transport so they can be recorded and replayed (see cassette.py).
+# It is created on first use, so importing app.py (e.g. in spawned worker processes) has no side effects.
+transport_lock = threading.Lock()
+transport = None
+
+def gemini_transport():
     """
-    Extracts text from a FileStorage object (txt, docx, pdf).
+    Returns the transport for Gemini calls, creating it on first use.
+    """
+    global transport
+    with transport_lock:
+        if transport is None:
+            transport = get_transport()
+        return transport
+
+
+class GradingCancelled(Exception):
+    """
+    Raised when the client that requested grading has disconnected.
     """
-    filename = file_storage.filename.lower()
-    if filename.endswith('.docx'):
-        doc = Document(file_storage)
-        return "\n".join([para.text for para in doc.paragraphs])
-    elif filename.endswith('.pdf'):
-        reader = PdfReader(file_storage)
-        return "\n".join([page.extract_text() for page in reader.pages])
-    else:
-        # Assume text-based
-        return file_storage.read().decode('utf-8', errors='ignore')
+
+
+def check_cancelled(cancel_event):
+    """
+    Raises GradingCancelled if the run has been cancelled.
+    """
+    if cancel_event is not None and cancel_event.is_set():
+        raise GradingCancelled()
+
+def wait_or_cancel(seconds, cancel_event):
+    """
+    Sleeps for the given time, waking up early with GradingCancelled if the run is cancelled.
+    """
+    if cancel_event is None:
+        time.sleep(seconds)
+    elif cancel_event.wait(seconds):
+        raise GradingCancelled()
+
+def wait_with_heartbeat(future):
+    """
+    Waits for a background task while yielding blank lines to the client.
+    Use with `yield from`; returns the task's result.
+    """
+    while True:
+        try:
+            return future.result(timeout=HEARTBEAT_INTERVAL)
+        except FutureTimeoutError:
+            yield '\n'
+
+
 
 def clean_json_text(text):
     """
@@ -115,7 +179,7 @@ def get_best_model(api_key):
     
     available_models = []
     try:
-        for m in genai.list_models():
+        for m in gemini_transport().list_models():
             if 'generateContent' in m.supported_generation_methods:
                 available_models.append(m.name)
     except Exception as e:
@@ -163,72 +227,214 @@ def get_best_model(api_key):
     logging.info(f"Selected Model: {selected_model_name}")
     return selected_model_name
 
-def grade_pdf(pdf_path, rubric_text, api_key):
+def select_grading_model():
     """
-    Grades a single PDF using Gemini.
+    Picks the model used for grading from the models available to the configured key.
     """
+    # Dynamically find a supported model
+    available_models = []
+    try:
+        for m in gemini_transport().list_models():
+            if 'generateContent' in m.supported_generation_methods:
+                available_models.append(m.name)
+    except Exception as e:
+        print(f"Error listing models: {e}")
+
+    # Priority list of preferred models
+    preferred_models = [
+        'models/gemini-3-pro-preview',
+        'models/gemini-3.0-pro',
+        'gemini-3.0-pro',
+        'models/gemini-1.5-pro',
+        'models/gemini-1.5-flash',
+        'models/gemini-1.5-flash-001',
+        'models/gemini-1.5-pro-001',
+        'models/gemini-pro-vision', # Fallback for older keys
+    ]
+
+    selected_model_name = None
+    
+    # 1. Try to find a preferred model in the available list
+    for pref in preferred_models:
+        if pref in available_models:
+            selected_model_name = pref
+            break
+    
+    # 2. If no preferred model found, pick the first available 'gemini' model
+    if not selected_model_name:
+        for m in available_models:
+            if 'gemini' in m and 'vision' not in m: # Avoid vision-only legacy if possible, unless 1.5
+                 # Actually 1.5 models handle everything. 
+                 # Let's just pick the first one that looks like a 1.5 model
+                 if '1.5' in m:
+                     selected_model_name = m
+                     break
+    
+    # 3. Last resort: just use the first available model or fallback to string
+    if not selected_model_name:
+         if available_models:
+             selected_model_name = available_models[0]
+         else:
+             selected_model_name = 'gemini-1.5-flash' # Blind hope
+
+    print(f"Selected Model: {selected_model_name}")
+    return selected_model_name
+
+def discard_upload(sample_file):
+    """
+    Deletes an uploaded file from Gemini after a cancelled run or a timed-out upload.
+    Disabled by setting DELETE_UPLOADS_ON_CANCEL=false.
+    """
+    if os.getenv('DELETE_UPLOADS_ON_CANCEL', 'true').lower() != 'true':
+        return
+    try:
+        gemini_transport().delete_file(sample_file.name)
+    except Exception as e:
+        logging.error(f"Error deleting uploaded file {sample_file.name}: {e}")
+
+def upload_pdf(pdf_path, cancel_event=None):
+    """
+    Uploads a PDF to Gemini and waits until it has finished processing.
+    Returns None if Gemini failed to process the file.
+    """
+    check_cancelled(cancel_event)
+    sample_file = gemini_transport().upload_file(pdf_path, os.path.basename(pdf_path))
+    
+    # Wait for the file to be active
+    deadline = time.monotonic() + PROCESSING_TIMEOUT
     try:
-        genai.configure(api_key=api_key)
-        
-        # Upload the file to Gemini
-        sample_file = genai.upload_file(path=pdf_path, display_name=os.path.basename(pdf_path))
-        
-        # Wait for the file to be active
         while sample_file.state.name == "PROCESSING":
-            time.sleep(1)
-            sample_file = genai.get_file(sample_file.name)
+            if time.monotonic() > deadline:
+                discard_upload(sample_file)
+                raise Exception(f"File was still processing after {PROCESSING_TIMEOUT:.0f} seconds")
+            wait_or_cancel(gemini_transport().wait_time(1), cancel_event)
+            sample_file = gemini_transport().get_file(sample_file.name)
+    except GradingCancelled:
+        discard_upload(sample_file)
+        raise
 
-        if sample_file.state.name == "FAILED":
-            return {"error": "File processing failed by Gemini", "file": os.path.basename(pdf_path)}
+    if sample_file.state.name == "FAILED":
+        return None
+    return sample_file
+
+def kind_stats(kind):
+    """
+    Returns the hedging stats for a call kind. Callers must hold hedge_lock.
+    """
+    return hedge_stats.setdefault(kind, {"latencies": deque(maxlen=50), "calls": 0, "hedges": 0})
+
+def hedge_delay(kind):
+    """
+    Returns how long to wait before sending a duplicate request, or None if no hedge should be sent.
+    """
+    with hedge_lock:
+        stats = kind_stats(kind)
+        stats["calls"] += 1
+        latencies = sorted(stats["latencies"])
+        if len(latencies) < HEDGE_MIN_SAMPLES:
+            return None
+        if stats["hedges"] >= HEDGE_BUDGET * stats["calls"]:
+            return None
+    return latencies[int(HEDGE_PERCENTILE * (len(latencies) - 1))]
+
+def generate_with_deadline(model, contents, generation_config=None, cancel_event=None, kind='grade'):
+    """
+    Calls generate_content with a per-call deadline, hedging slow calls when HEDGE_ENABLED is set.
+    """
+    request_options = {"timeout": GENERATE_TIMEOUT}
 
-        # Dynamically find a supported model
-        available_models = []
+    def call():
+        started = time.monotonic()
+        response = gemini_transport().generate_content(model, contents, generation_config, request_options)
+        with hedge_lock:
+            kind_stats(kind)["latencies"].append(time.monotonic() - started)
+        return response
+
+    if not HEDGE_ENABLED:
+        return call()
+
+    delay = hedge_delay(kind)
+    deadline = time.monotonic() + GENERATE_TIMEOUT
+    pending = {hedge_executor.submit(call)}
+    hedge_at = time.monotonic() + delay if delay is not None else None
+    last_error = None
+
+    while pending:
+        check_cancelled(cancel_event)
+        now = time.monotonic()
+        if now > deadline:
+            raise TimeoutError(f"generate_content did not finish within {GENERATE_TIMEOUT:.0f} seconds")
+        if hedge_at is not None and now >= hedge_at:
+            with hedge_lock:
+                kind_stats(kind)["hedges"] += 1
+            logging.info(f"Hedging {kind} generate_content after {delay:.1f}s")
+            pending.add(hedge_executor.submit(call))
+            hedge_at = None
+
+        timeout = min(1, max(0, (hedge_at or deadline) - now))
+        done, pending = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+        for future in done:
+            try:
+                return future.result()
+            except Exception as e:
+                # Keep waiting on the other request if one is still running
+                last_error = e
+
+    raise last_error
+
+def generate_json_with_retries(model, contents, label, cancel_event=None, kind='grade'):
+    """
+    Calls generate_content with retries and parses the JSON response.
+    """
+    max_retries = 3
+    retry_delay = 2 # seconds
+
+    for attempt in range(max_retries):
+        check_cancelled(cancel_event)
         try:
-            for m in genai.list_models():
-                if 'generateContent' in m.supported_generation_methods:
-                    available_models.append(m.name)
+            response = generate_with_deadline(model, contents, {"response_mime_type": "application/json"}, cancel_event, kind)
+            cleaned_text = clean_json_text(response.text)
+            return json.loads(cleaned_text)
+        except GradingCancelled:
+            raise
         except Exception as e:
-            print(f"Error listing models: {e}")
-
-        # Priority list of preferred models
-        preferred_models = [
-            'models/gemini-3-pro-preview',
-            'models/gemini-3.0-pro',
-            'gemini-3.0-pro',
-            'models/gemini-1.5-pro',
-            'models/gemini-1.5-flash',
-            'models/gemini-1.5-flash-001',
-            'models/gemini-1.5-pro-001',
-            'models/gemini-pro-vision', # Fallback for older keys
-        ]
-
-        selected_model_name = None
-        
-        # 1. Try to find a preferred model in the available list
-        for pref in preferred_models:
-            if pref in available_models:
-                selected_model_name = pref
-                break
-        
-        # 2. If no preferred model found, pick the first available 'gemini' model
-        if not selected_model_name:
-            for m in available_models:
-                if 'gemini' in m and 'vision' not in m: # Avoid vision-only legacy if possible, unless 1.5
-                     # Actually 1.5 models handle everything. 
-                     # Let's just pick the first one that looks like a 1.5 model
-                     if '1.5' in m:
-                         selected_model_name = m
-                         break
+            if attempt < max_retries - 1:
+                logging.warning(f"Attempt {attempt + 1} failed for {label}: {e}. Retrying...")
+                wait_or_cancel(gemini_transport().wait_time(retry_delay * (attempt + 1)), cancel_event) # Exponential backoff
+            else:
+                raise e # Re-raise the last exception if all retries fail
+
+def question_fields_prompt(anti_cheating):
+    """
+    Returns the JSON fields requested for each question.
+    The anti-cheating fields feed the cross-student analysis in the Teacher Summary.
+    """
+    fields = """
+                    "question_number": <string>,
+                    "score": <number>,
+                    "max_points": <number>,
+                    "feedback": "<string>",
+                    "partial_credit_awarded": <boolean>"""
+    if anti_cheating:
+        fields += """,
+                    "student_reasoning": "<string: short transcription of the student's steps>",
+                    "final_answer": "<string>"
+    """.rstrip()
+    return fields
+
+def grade_pdf(pdf_path, rubric_text, api_key, anti_cheating=False, privacy_mode=False, cancel_event=None):
+    """
+    Grades a single PDF using Gemini.
+    """
+    try:
+        genai.configure(api_key=api_key)
         
-        # 3. Last resort: just use the first available model or fallback to string
-        if not selected_model_name:
-             if available_models:
-                 selected_model_name = available_models[0]
-             else:
-                 selected_model_name = 'gemini-1.5-flash' # Blind hope
+        # Upload the file to Gemini
+        sample_file = upload_pdf(pdf_path, cancel_event)
+        if sample_file is None:
+            return {"error": "File processing failed by Gemini", "file": os.path.basename(pdf_path)}
 
-        print(f"Selected Model: {selected_model_name}")
-        model = genai.GenerativeModel(selected_model_name)
+        model = genai.GenerativeModel(select_grading_model())
 
         prompt = f"""
         You are an expert Algebra teacher. Your task is to grade the student's quiz submission (attached PDF) based on the provided rubric.
@@ -253,39 +459,283 @@ def grade_pdf(pdf_path, rubric_text, api_key):
             "total_score": <number>,
             "max_score": <number>,
             "questions": [
-                {{
-                    "question_number": <string>,
-                    "score": <number>,
-                    "max_points": <number>,
-                    "feedback": "<string>",
-                    "partial_credit_awarded": <boolean>
+                {{{question_fields_prompt(anti_cheating)}
                 }}
             ],
             "overall_feedback": "<string>"
         }}
         """
 
-        max_retries = 3
-        retry_delay = 2 # seconds
-
-        for attempt in range(max_retries):
-            try:
-                response = model.generate_content([sample_file, prompt], generation_config={"response_mime_type": "application/json"})
-                cleaned_text = clean_json_text(response.text)
-                return json.loads(cleaned_text)
-            except Exception as e:
-                if attempt < max_retries - 1:
-                    logging.warning(f"Attempt {attempt + 1} failed for {os.path.basename(pdf_path)}: {e}. Retrying...")
-                    time.sleep(retry_delay * (attempt + 1)) # Exponential backoff
-                else:
-                    raise e # Re-raise the last exception if all retries fail
+        try:
+            return generate_json_with_retries(model, [sample_file, prompt], os.path.basename(pdf_path), cancel_event)
+        except GradingCancelled:
+            discard_upload(sample_file)
+            raise
 
+    except GradingCancelled:
+        raise
     except Exception as e:
         error_msg = f"Error grading {os.path.basename(pdf_path)}: {str(e)}"
         print(error_msg)
         logging.error(error_msg)
         return {"error": str(e), "file": os.path.basename(pdf_path)}
 
+def normalize_question_number(question_number):
+    """
+    Normalizes question labels so 'Q1', 'Question 1' and '1.' compare equal.
+    """
+    text = str(question_number).strip().lower()
+    text = re.sub(r'^(question|problem|q)\s*#?\s*', '', text)
+    return text.strip(' .):')
+
+def split_rubric_sections(rubric_text):
+    """
+    Splits a rubric into a preamble and per-question sections.
+    Returns (preamble, {question_number: section_text}).
+    """
+    # Prefer explicit "Question 1" / "Q1" / "Problem 1" headers. Only fall back to
+    # "1." / "1)" numbering when there are none, since those also appear inside sections.
+    header_patterns = [
+        r'^\s*[*#]*\s*(?:question|problem|q)\s*#?\s*(\d+[a-z]?)\b',
+        r'^\s*[*#]*\s*(\d+[a-z]?)\s*[.)]\s',
+    ]
+    lines = rubric_text.splitlines()
+
+    for pattern in header_patterns:
+        headers = []
+        for i, line in enumerate(lines):
+            match = re.match(pattern, line, re.IGNORECASE)
+            if match:
+                headers.append((i, normalize_question_number(match.group(1))))
+        if headers:
+            break
+    else:
+        return rubric_text.strip(), {}
+
+    # Plain numbering is ambiguous: numbered steps inside a question look like headers.
+    # Only trust it if the numbers strictly increase; otherwise the rubric cannot be split.
+    if pattern == header_patterns[-1]:
+        def order_key(number):
+            digits = re.match(r'\d+', number).group()
+            return int(digits), number[len(digits):]
+        keys = [order_key(number) for _, number in headers]
+        if any(later <= earlier for earlier, later in zip(keys, keys[1:])):
+            return rubric_text.strip(), {}
+
+    preamble = "\n".join(lines[:headers[0][0]]).strip()
+    sections = {}
+    for idx, (start, number) in enumerate(headers):
+        end = headers[idx + 1][0] if idx + 1 < len(headers) else len(lines)
+        section_text = "\n".join(lines[start:end]).strip()
+        # Repeated "Question N" headers (e.g. a rubric and an answer key in one file) are merged
+        if number in sections:
+            sections[number] += "\n" + section_text
+        else:
+            sections[number] = section_text
+    return preamble, sections
+
+def rubric_fingerprint(rubric_text):
+    """
+    Hashes each rubric section so later runs can tell which questions changed.
+    Whitespace differences are ignored.
+    """
+    def digest(text):
+        return hashlib.sha256(" ".join(text.split()).encode('utf-8')).hexdigest()
+
+    preamble, sections = split_rubric_sections(rubric_text)
+    return {
+        "preamble": digest(preamble),
+        "questions": {number: digest(text) for number, text in sections.items()},
+    }
+
+def changed_rubric_questions(old_fingerprint, new_fingerprint, graded_questions=()):
+    """
+    Returns the set of question numbers whose rubric section was changed, added or removed.
+    Returns None when the change cannot be localized and the whole quiz must be regraded,
+    including when a graded question (e.g. '1a' under a 'Question 1' section) has no matching section.
+    """
+    if not old_fingerprint or not old_fingerprint.get('questions') or not new_fingerprint.get('questions'):
+        return None
+    if old_fingerprint.get('preamble') != new_fingerprint.get('preamble'):
+        return None
+
+    old_questions = old_fingerprint['questions']
+    new_questions = new_fingerprint['questions']
+    for q in graded_questions:
+        if normalize_question_number(q.get('question_number')) not in old_questions:
+            return None
+    return {
+        number for number in set(old_questions) | set(new_questions)
+        if old_questions.get(number) != new_questions.get(number)
+    }
+
+def regrade_questions(pdf_path, rubric_text, question_numbers, api_key, anti_cheating=False, cancel_event=None):
+    """
+    Re-grades only the given questions of a single PDF.
+    Returns {"questions": [...]} or an error dict like grade_pdf.
+    """
+    try:
+        genai.configure(api_key=api_key)
+
+        sample_file = upload_pdf(pdf_path, cancel_event)
+        if sample_file is None:
+            return {"error": "File processing failed by Gemini", "file": os.path.basename(pdf_path)}
+
+        model = genai.GenerativeModel(select_grading_model())
+
+        _, sections = split_rubric_sections(rubric_text)
+        question_list = ", ".join(sorted(question_numbers))
+        sections_text = "\n".join(sections[number] for number in sorted(question_numbers) if number in sections)
+
+        prompt = f"""
+        You are an expert Algebra teacher. The rubric for some questions of this quiz was corrected, and you must re-grade ONLY those questions in the student's submission (attached PDF).
+        
+        **Full Rubric (for context):**
+        {rubric_text}
+        
+        **Questions to re-grade:** {question_list}
+        
+        **Instructions:**
+        1. Grade ONLY the questions listed above, using the rubric sections below. Do not include any other question.
+        2. **CRITICAL:** Award partial credit for correct steps or logic, even if the final answer is wrong or if the method differs slightly from the rubric but is mathematically valid.
+        3. **Feedback Requirement:** For each question, provide a detailed explanation of where exactly points were lost.
+        4. **Math Formatting:** Do NOT use LaTeX formatting. Use standard Unicode mathematical symbols.
+        
+        **Rubric sections to apply:**
+        {sections_text}
+        
+        **Output Format:**
+        Return the result as a valid JSON object with the following structure:
+        {{
+            "questions": [
+                {{{question_fields_prompt(anti_cheating)}
+                }}
+            ]
+        }}
+        """
+
+        try:
+            return generate_json_with_retries(model, [sample_file, prompt], os.path.basename(pdf_path), cancel_event, kind='regrade')
+        except GradingCancelled:
+            discard_upload(sample_file)
+            raise
+
+    except GradingCancelled:
+        raise
+    except Exception as e:
+        error_msg = f"Error re-grading {os.path.basename(pdf_path)}: {str(e)}"
+        print(error_msg)
+        logging.error(error_msg)
+        return {"error": str(e), "file": os.path.basename(pdf_path)}
+
+def merge_regraded_questions(result, regraded_questions, changed_questions, new_fingerprint):
+    """
+    Replaces the changed questions in a cached result and recomputes the totals.
+    Questions removed from the rubric are dropped.
+    Returns None if a changed question that is still in the rubric is missing from regraded_questions.
+    """
+    current_questions = new_fingerprint['questions']
+    regraded = {
+        normalize_question_number(q.get('question_number')): q
+        for q in regraded_questions
+        if normalize_question_number(q.get('question_number')) in changed_questions
+    }
+    missing = {number for number in changed_questions if number in current_questions} - set(regraded)
+    if missing:
+        logging.warning(f"Regrade response is missing questions {sorted(missing)}")
+        return None
+
+    merged = []
+    for q in result.get('questions', []):
+        number = normalize_question_number(q.get('question_number'))
+        if number in changed_questions:
+            if number in regraded:
+                merged.append(regraded.pop(number))
+            continue
+        merged.append(q)
+    # Questions newly added to the rubric
+    merged.extend(q for number, q in regraded.items() if number in current_questions)
+
+    # Keep rubric order
+    order = {number: i for i, number in enumerate(current_questions)}
+    merged.sort(key=lambda q: order.get(normalize_question_number(q.get('question_number')), len(order)))
+
+    result = dict(result)
+    result['questions'] = merged
+    result['total_score'] = sum(q.get('score', 0) for q in merged)
+    result['max_score'] = sum(q.get('max_points', 0) for q in merged)
+    result['rubric_fingerprint'] = new_fingerprint
+    return result
+
+def grade_quiz(pdf_file, json_path, rubric_text, current_fingerprint, api_key,
+               anti_cheating=False, privacy_mode=False, regrade_mode=False, cancel_event=None):
+    """
+    Loads, regrades or grades a single quiz and checkpoints the result to json_path.
+    Returns (result, result_changed).
+    """
+    base_name = os.path.basename(pdf_file)
+
+    result = None
+    result_changed = False
+
+    # RESUME CAPABILITY: Check if result already exists
+    if os.path.exists(json_path):
+        try:
+            with open(json_path, 'r') as f:
+                result = json.load(f)
+            result['filename'] = base_name # Ensure filename matches
+            logging.info(f"Resuming: Loaded cached result for {base_name}")
+        except Exception as e:
+            logging.error(f"Error loading cached result for {base_name}: {e}")
+
+    # REGRADE MODE: Only re-evaluate the questions whose rubric section changed
+    if result and regrade_mode:
+        changed_questions = changed_rubric_questions(
+            result.get('rubric_fingerprint'), current_fingerprint, result.get('questions', [])
+        )
+        if changed_questions is None:
+            logging.info(f"Regrade: Rubric change for {base_name} cannot be localized, regrading fully")
+            result = None
+        elif changed_questions:
+            # Sections that were only removed are dropped locally, without asking the model
+            to_regrade = {number for number in changed_questions if number in current_fingerprint['questions']}
+            regraded = {"questions": []}
+            if to_regrade:
+                logging.info(f"Regrade: Re-evaluating questions {sorted(to_regrade)} for {base_name}")
+                regraded = regrade_questions(pdf_file, rubric_text, to_regrade, api_key, anti_cheating=anti_cheating, cancel_event=cancel_event)
+            if "error" in regraded:
+                result = regraded
+            else:
+                result = merge_regraded_questions(result, regraded.get('questions', []), changed_questions, current_fingerprint)
+                if result is None:
+                    # Never keep a partial merge: grade the whole quiz instead
+                    logging.warning(f"Regrade: Incomplete response for {base_name}, regrading fully")
+            if result is not None:
+                result['filename'] = base_name
+                result_changed = True
+
+    # If not found or error loading, grade it
+    if not result:
+        # Pass anti_cheating and privacy_mode flags to grade_pdf
+        result = grade_pdf(pdf_file, rubric_text, api_key, anti_cheating=anti_cheating, privacy_mode=privacy_mode, cancel_event=cancel_event)
+        result['filename'] = base_name
+        if "error" not in result:
+            result['rubric_fingerprint'] = current_fingerprint
+        result_changed = True
+
+    # Save result for future resumption.
+    # Write to a temp file first so an interrupted run never leaves a truncated checkpoint.
+    if result_changed and "error" not in result:
+        try:
+            tmp_path = json_path + '.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(result, f, indent=4)
+            os.replace(tmp_path, json_path)
+        except Exception as e:
+            logging.error(f"Error saving result cache for {base_name}: {e}")
+
+    return result, result_changed
+
 def generate_feedback_pdf(feedback_data, output_path):
     """
     Generates a PDF feedback report using ReportLab.
@@ -352,7 +802,7 @@ def generate_feedback_pdf(feedback_data, output_path):
 
     doc.build(story)
 
-def generate_teacher_summary(all_results, output_path, api_key, anti_cheating=False):
+def generate_teacher_summary(all_results, output_path, api_key, anti_cheating=False, cancel_event=None):
     """
     Generates a summary PDF of common misconceptions and errors.
     Optionally analyzes for cheating.
@@ -435,7 +885,8 @@ def generate_teacher_summary(all_results, output_path, api_key, anti_cheating=Fa
         {aggregated_text[:30000]} # Truncate if too long to avoid token limits
         """
         
-        response = model.generate_content(prompt)
+        check_cancelled(cancel_event)
+        response = generate_with_deadline(model, prompt, cancel_event=cancel_event, kind='summary')
         summary_text = response.text
         
         # Generate PDF
@@ -501,9 +952,16 @@ def generate_teacher_summary(all_results, output_path, api_key, anti_cheating=Fa
         doc.build(story)
         logging.info(f"Teacher Summary saved to {output_path}")
 
+    except GradingCancelled:
+        logging.info("Teacher Summary skipped: grading was cancelled")
     except Exception as e:
         logging.error(f"Error generating Teacher Summary: {e}")
 
+@app.errorhandler(413)
+def upload_too_large(e):
+    # JSON so the page can show the message (script.js reads data.error)
+    return jsonify({"error": f"Rubric file is larger than {float(os.getenv('MAX_DOCUMENT_MB', 25)):g} MB"}), 413
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -518,6 +976,7 @@ def grade():
     # Get flags (strings 'true'/'false' from JS FormData)
     privacy_mode = request.form.get('privacy_mode') == 'true'
     anti_cheating = request.form.get('anti_cheating') == 'true'
+    regrade_mode = request.form.get('regrade_mode') == 'true'
 
     if not folder_path or not os.path.isdir(folder_path):
         return jsonify({"error": "Invalid folder path"}), 400
@@ -532,6 +991,8 @@ def grade():
     except Exception as e:
         return jsonify({"error": f"Failed to read rubric file: {str(e)}"}), 400
 
+    current_fingerprint = rubric_fingerprint(rubric_text)
+
     pdf_files = glob.glob(os.path.join(folder_path, "*.pdf"))
     
     if not pdf_files:
@@ -543,72 +1004,71 @@ def grade():
     feedback_folder = os.path.join(folder_path, "feedback")
     os.makedirs(feedback_folder, exist_ok=True)
 
+    # Set when the client disconnects so in-flight uploads, polls and retries stop early
+    cancel_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=1)
+
     def generate():
         all_results = [] # Accumulate results for summary
+        completed = False
         
-        for pdf_file in pdf_files:
-            base_name = os.path.basename(pdf_file)
-            json_filename = f"{os.path.splitext(base_name)[0]}_result.json"
-            json_path = os.path.join(feedback_folder, json_filename)
-            
-            result = None
-            
-            # RESUME CAPABILITY: Check if result already exists
-            if os.path.exists(json_path):
-                try:
-                    with open(json_path, 'r') as f:
-                        result = json.load(f)
-                    result['filename'] = base_name # Ensure filename matches
-                    logging.info(f"Resuming: Loaded cached result for {base_name}")
-                except Exception as e:
-                    logging.error(f"Error loading cached result for {base_name}: {e}")
-            
-            # If not found or error loading, grade it
-            if not result:
-                # Pass anti_cheating and privacy_mode flags to grade_pdf
-                result = grade_pdf(pdf_file, rubric_text, api_key, anti_cheating=anti_cheating, privacy_mode=privacy_mode)
-                result['filename'] = base_name
+        try:
+            for pdf_file in pdf_files:
+                base_name = os.path.basename(pdf_file)
+                json_filename = f"{os.path.splitext(base_name)[0]}_result.json"
+                json_path = os.path.join(feedback_folder, json_filename)
                 
-                # Save result for future resumption
+                # Grade in the background; the result is checkpointed even if the client leaves meanwhile
+                future = executor.submit(
+                    grade_quiz, pdf_file, json_path, rubric_text, current_fingerprint, api_key,
+                    anti_cheating=anti_cheating, privacy_mode=privacy_mode,
+                    regrade_mode=regrade_mode, cancel_event=cancel_event
+                )
+                result, result_changed = yield from wait_with_heartbeat(future)
+                
+                # Generate Feedback PDF
                 if "error" not in result:
                     try:
-                        with open(json_path, 'w') as f:
-                            json.dump(result, f, indent=4)
+                        student_name = result.get('student_name', 'Student').replace('/', '-')
+                        quiz_name = result.get('quiz_name', 'Quiz').replace('/', '-')
+                        pdf_filename = f"{student_name} Feedback {quiz_name}.pdf"
+                        output_path = os.path.join(feedback_folder, pdf_filename)
+                        
+                        # Only generate PDF if it doesn't exist or the grade changed (speed up resume)
+                        if result_changed or not os.path.exists(output_path):
+                            generate_feedback_pdf(result, output_path)
                     except Exception as e:
-                        logging.error(f"Error saving result cache for {base_name}: {e}")
-            
-            # Generate Feedback PDF
-            if "error" not in result:
-                try:
-                    student_name = result.get('student_name', 'Student').replace('/', '-')
-                    quiz_name = result.get('quiz_name', 'Quiz').replace('/', '-')
-                    pdf_filename = f"{student_name} Feedback {quiz_name}.pdf"
-                    output_path = os.path.join(feedback_folder, pdf_filename)
-                    
-                    # Only generate PDF if it doesn't exist (speed up resume)
-                    if not os.path.exists(output_path):
-                        generate_feedback_pdf(result, output_path)
-                except Exception as e:
-                    error_msg = f"Error generating PDF for {pdf_file}: {e}"
-                    print(error_msg)
-                    logging.error(error_msg)
-                    result['pdf_error'] = str(e)
-            
-            # Yield result as JSON line
-            yield json.dumps(result) + '\n'
-            
-            # Add to accumulation list
-            all_results.append(result)
+                        error_msg = f"Error generating PDF for {pdf_file}: {e}"
+                        print(error_msg)
+                        logging.error(error_msg)
+                        result['pdf_error'] = str(e)
+                
+                # Yield result as JSON line
+                yield json.dumps(result) + '\n'
+                
+                # Add to accumulation list
+                all_results.append(result)
 
-        # Generate Teacher Summary after all quizzes are processed
-        try:
-            summary_path = os.path.join(feedback_folder, "Teacher_Summary.pdf")
-            # Pass anti_cheating flag to summary generator
-            generate_teacher_summary(all_results, summary_path, api_key, anti_cheating=anti_cheating)
-            # Optional: Yield a special event or log indicating summary is ready
-            # yield json.dumps({"info": "Teacher Summary Generated"}) + '\n'
-        except Exception as e:
-            logging.error(f"Failed to trigger teacher summary: {e}")
+            # Generate Teacher Summary after all quizzes are processed
+            try:
+                summary_path = os.path.join(feedback_folder, "Teacher_Summary.pdf")
+                # Pass anti_cheating flag to summary generator
+                future = executor.submit(
+                    generate_teacher_summary, all_results, summary_path, api_key,
+                    anti_cheating=anti_cheating, cancel_event=cancel_event
+                )
+                yield from wait_with_heartbeat(future)
+                # Optional: Yield a special event or log indicating summary is ready
+                # yield json.dumps({"info": "Teacher Summary Generated"}) + '\n'
+            except Exception as e:
+                logging.error(f"Failed to trigger teacher summary: {e}")
+            completed = True
+        finally:
+            # Runs when the generator is closed, including when the client disconnects
+            if not completed:
+                logging.info(f"Grading cancelled after {len(all_results)} of {len(pdf_files)} quizzes")
+            cancel_event.set()
+            executor.shutdown(wait=False)
 
     return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
@@ -0,0 +1,290 @@
+"""
+Record/replay layer for Gemini calls.
+
+Every call app.py makes to Gemini goes through the transport returned by get_transport().
+The mode is chosen with CASSETTE_MODE in .env:
+
+    live         Call Gemini directly (default).
+    record       Call Gemini and append each interaction to the cassette before returning.
+    passthrough  Call Gemini and write interactions to the cassette in the background.
+    replay       Never call Gemini; answer from the cassette.
+
+A cassette is a JSON Lines file (CASSETTE_PATH) with one interaction per line:
+the call kind, a fingerprint of the request, the response and how long the call took.
+In replay, CASSETTE_LATENCY controls timing: 'original' sleeps for the recorded time,
+'none' answers immediately, and a number scales the recorded time (e.g. 0.1). The same
+factor scales the app's own waits between upload polls and retries (see wait_time).
+"""
+import os
+import json
+import time
+import queue
+import atexit
+import hashlib
+import logging
+import threading
+from types import SimpleNamespace
+import google.generativeai as genai
+
+
+class CassetteMiss(Exception):
+    """
+    Raised in replay mode when the cassette has no recording for a request.
+    """
+
+
+class CassetteError(Exception):
+    """
+    Raised when the cassette configuration cannot be used, e.g. replay without a cassette file.
+    """
+
+
+def file_sha256(path):
+    """
+    Hashes a local file in chunks.
+    """
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LiveTransport:
+    """
+    Calls Gemini directly.
+    """
+
+    def __init__(self):
+        # Remote file name -> hash of the local file, so requests can be fingerprinted
+        # independently of the random names Gemini gives uploads. Only filled when recording or replaying.
+        self.file_hashes = {}
+        self.lock = threading.Lock()
+
+    def list_models(self):
+        return list(genai.list_models())
+
+    def upload_file(self, path, display_name):
+        return genai.upload_file(path=path, display_name=display_name)
+
+    def get_file(self, name):
+        return genai.get_file(name)
+
+    def delete_file(self, name):
+        genai.delete_file(name)
+
+    def wait_time(self, seconds):
+        """
+        Returns how long the app should actually wait between polls or retries.
+        """
+        return seconds
+
+    def generate_content(self, model, contents, generation_config=None, request_options=None):
+        return model.generate_content(contents, generation_config=generation_config, request_options=request_options)
+
+    def fingerprint(self, kind, payload):
+        """
+        Hashes a request so the same request in a later run maps to the same recording.
+        """
+        def normalize(part):
+            if isinstance(part, str):
+                return part
+            if isinstance(part, (list, tuple)):
+                return [normalize(p) for p in part]
+            if isinstance(part, dict):
+                return {str(k): normalize(v) for k, v in part.items()}
+            name = getattr(part, 'name', None)
+            if name is not None:
+                with self.lock:
+                    return "file:" + self.file_hashes.get(name, name)
+            return str(part)
+
+        text = json.dumps([kind, normalize(payload)], sort_keys=True)
+        return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class RecordingTransport(LiveTransport):
+    """
+    Calls Gemini and records each interaction to the cassette.
+    With write_behind, recordings are written by a background thread so they add no latency.
+    """
+
+    def __init__(self, path, write_behind=False):
+        super().__init__()
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.write_lock = threading.Lock()
+        self.pending = None
+        if write_behind:
+            self.pending = queue.Queue()
+            threading.Thread(target=self.write_pending, daemon=True).start()
+            atexit.register(self.pending.join)
+
+    def write(self, entry):
+        line = json.dumps(entry) + '\n'
+        with self.write_lock:
+            with open(self.path, 'a') as f:
+                f.write(line)
+
+    def write_pending(self):
+        while True:
+            entry = self.pending.get()
+            try:
+                self.write(entry)
+            except Exception as e:
+                logging.error(f"Error writing cassette entry: {e}")
+            finally:
+                self.pending.task_done()
+
+    def record(self, kind, fingerprint, started, response=None, error=None):
+        entry = {
+            "kind": kind,
+            "fingerprint": fingerprint,
+            "elapsed": time.monotonic() - started,
+            "response": response,
+            "error": error,
+        }
+        if self.pending is not None:
+            self.pending.put(entry)
+        else:
+            self.write(entry)
+
+    def call(self, kind, fingerprint, func, to_json):
+        started = time.monotonic()
+        try:
+            result = func()
+            # Inside the try: reading e.g. response.text can raise for blocked responses
+            response = to_json(result)
+        except Exception as e:
+            self.record(kind, fingerprint, started, error=str(e))
+            raise
+        self.record(kind, fingerprint, started, response=response)
+        return result
+
+    def list_models(self):
+        return self.call(
+            'list_models', self.fingerprint('list_models', None), super().list_models,
+            lambda models: [
+                {"name": m.name, "supported_generation_methods": list(m.supported_generation_methods)}
+                for m in models
+            ]
+        )
+
+    def upload_file(self, path, display_name):
+        sha = file_sha256(path)
+        sample_file = self.call(
+            'upload_file', self.fingerprint('upload_file', "file:" + sha),
+            lambda: super(RecordingTransport, self).upload_file(path, display_name),
+            lambda f: {"state": f.state.name}
+        )
+        with self.lock:
+            self.file_hashes[sample_file.name] = sha
+        return sample_file
+
+    def get_file(self, name):
+        return self.call(
+            'get_file', self.fingerprint('get_file', SimpleNamespace(name=name)),
+            lambda: super(RecordingTransport, self).get_file(name),
+            lambda f: {"state": f.state.name}
+        )
+
+    def generate_content(self, model, contents, generation_config=None, request_options=None):
+        fingerprint = self.fingerprint('generate_content', [model.model_name, contents, generation_config or {}])
+        return self.call(
+            'generate_content', fingerprint,
+            lambda: super(RecordingTransport, self).generate_content(model, contents, generation_config, request_options),
+            lambda response: {"text": response.text}
+        )
+
+
+class ReplayTransport(LiveTransport):
+    """
+    Answers every call from a cassette without contacting Gemini.
+    Repeated identical requests get their recordings in order; the last one is reused after that.
+    """
+
+    def __init__(self, path, latency='original'):
+        super().__init__()
+        self.latency_scale = {'original': 1.0, 'none': 0.0}.get(latency)
+        if self.latency_scale is None:
+            try:
+                self.latency_scale = max(0.0, float(latency))
+            except ValueError:
+                logging.error(f"Invalid CASSETTE_LATENCY '{latency}', replaying with original timing")
+                self.latency_scale = 1.0
+        if not os.path.exists(path):
+            message = f"CASSETTE_MODE=replay but no cassette exists at {path}. Record one with CASSETTE_MODE=record first."
+            logging.error(message)
+            raise CassetteError(message)
+        self.recordings = {}
+        self.positions = {}
+        with open(path, 'r') as f:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    self.recordings.setdefault(entry['fingerprint'], []).append(entry)
+
+    def replay(self, kind, fingerprint):
+        with self.lock:
+            entries = self.recordings.get(fingerprint)
+            if not entries:
+                raise CassetteMiss(f"No recorded {kind} for request {fingerprint[:12]}")
+            position = self.positions.get(fingerprint, 0)
+            self.positions[fingerprint] = position + 1
+            entry = entries[min(position, len(entries) - 1)]
+
+        if self.latency_scale:
+            time.sleep(entry['elapsed'] * self.latency_scale)
+        if entry.get('error') is not None:
+            raise Exception(entry['error'])
+        return entry['response']
+
+    def list_models(self):
+        models = self.replay('list_models', self.fingerprint('list_models', None))
+        return [SimpleNamespace(**m) for m in models]
+
+    def replayed_file(self, name, response):
+        return SimpleNamespace(name=name, state=SimpleNamespace(name=response['state']))
+
+    def upload_file(self, path, display_name):
+        sha = file_sha256(path)
+        response = self.replay('upload_file', self.fingerprint('upload_file', "file:" + sha))
+        name = f"files/cassette-{sha[:16]}"
+        with self.lock:
+            self.file_hashes[name] = sha
+        return self.replayed_file(name, response)
+
+    def get_file(self, name):
+        response = self.replay('get_file', self.fingerprint('get_file', SimpleNamespace(name=name)))
+        return self.replayed_file(name, response)
+
+    def delete_file(self, name):
+        pass
+
+    def wait_time(self, seconds):
+        return seconds * self.latency_scale
+
+    def generate_content(self, model, contents, generation_config=None, request_options=None):
+        fingerprint = self.fingerprint('generate_content', [model.model_name, contents, generation_config or {}])
+        response = self.replay('generate_content', fingerprint)
+        return SimpleNamespace(text=response['text'])
+
+
+def get_transport():
+    """
+    Builds the transport selected by CASSETTE_MODE.
+    """
+    mode = os.getenv('CASSETTE_MODE', 'live').lower()
+    path = os.getenv('CASSETTE_PATH', os.path.join('cassettes', 'grading.jsonl'))
+
+    if mode == 'record':
+        return RecordingTransport(path)
+    if mode == 'passthrough':
+        return RecordingTransport(path, write_behind=True)
+    if mode == 'replay':
+        return ReplayTransport(path, latency=os.getenv('CASSETTE_LATENCY', 'original'))
+    if mode != 'live':
+        logging.error(f"Unknown CASSETTE_MODE '{mode}', calling Gemini directly")
+    return LiveTransport()
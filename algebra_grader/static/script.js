@@ -31,6 +31,7 @@ document.addEventListener('DOMContentLoaded', () => {
         const rubricFile = document.getElementById('rubricFile').files[0];
         const privacyCheck = document.getElementById('privacyCheck').checked;
         const antiCheatingCheck = document.getElementById('antiCheatingCheck').checked;
+        const regradeCheck = document.getElementById('regradeCheck').checked;
 
         if (!folderPath) {
             alert('Please select a folder first.');
@@ -71,6 +72,7 @@ document.addEventListener('DOMContentLoaded', () => {
             formData.append('rubric_file', rubricFile);
             formData.append('privacy_mode', privacyCheck);
             formData.append('anti_cheating', antiCheatingCheck);
+            formData.append('regrade_mode', regradeCheck);
 
             const response = await fetch('/grade', {
                 method: 'POST',